@@ -1,13 +1,23 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
-import easyocr
+import cv2
 from openpyxl import load_workbook
 from openpyxl.styles import PatternFill, Font
-from PIL import Image, ImageEnhance
+from PIL import Image
 import re
 import os
 import shutil
+import io
+import hashlib
+import csv
+import time
+import threading
+
+try:
+    from pyzbar.pyzbar import decode, ZBarSymbol
+except ImportError:  # Falta la librería nativa zbar: se usa solo el OCR
+    decode = None
 
 # Colores para Excel
 COLOR_VERDE = PatternFill(start_color="00FF00", end_color="00FF00", fill_type="solid")
@@ -18,11 +28,36 @@ st.write("La aplicación detecta códigos automáticamente y actualiza el Excel
 
 EXCEL_PATH = "inventario.xlsx"
 BACKUP_PATH = "inventario_backup.xlsx"
+AUDIT_PATH = "inventario_audit.csv"
+# Segundos entre copias completas del Excel; entre copias basta el registro
+INTERVALO_BACKUP = 3600
 
-# Función para crear backup
+# Función para crear backup. El Excel nunca se reescribe en el mismo archivo
+# (ver actualizar_excel), así que un enlace duro es una copia instantánea segura.
+# Se llama con el lock del libro tomado (usa un nombre temporal fijo).
 def crear_backup():
-    if os.path.exists(EXCEL_PATH):
-        shutil.copy(EXCEL_PATH, BACKUP_PATH)
+    if not os.path.exists(EXCEL_PATH):
+        return
+    # Sin cambios desde el último backup: no hay nada que copiar
+    if os.path.exists(BACKUP_PATH) and (
+        os.path.samefile(EXCEL_PATH, BACKUP_PATH)
+        or os.path.getmtime(EXCEL_PATH) == os.path.getmtime(BACKUP_PATH)
+    ):
+        return
+    tmp = BACKUP_PATH + ".tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(EXCEL_PATH, tmp)
+    except OSError:  # Sistemas de archivos sin enlaces duros
+        shutil.copy2(EXCEL_PATH, tmp)
+    os.replace(tmp, BACKUP_PATH)
+
+# Registro incremental de cada cambio (agregar una línea en vez de copiar el
+# Excel completo). Con el último backup permite reconstruir el inventario.
+def registrar(codigo, estado):
+    with open(AUDIT_PATH, "a", newline="", encoding="utf-8") as f:
+        csv.writer(f).writerow([time.time(), codigo, estado])
 
 if not os.path.exists(EXCEL_PATH):
     st.error("No se encontró 'inventario.xlsx'. Sube tu inventario inicial.")
@@ -33,13 +68,67 @@ if not os.path.exists(EXCEL_PATH):
         st.success("Inventario cargado exitosamente. Recarga la página para comenzar.")
     st.stop()
 
-wb = load_workbook(EXCEL_PATH)
-sheet = wb.active
-df = pd.read_excel(EXCEL_PATH)
+# Nombres de columna como los pone pd.read_excel: "Unnamed: n" para encabezados
+# vacíos y "codigo.1", "codigo.2"... para repetidos (primero se numeran las
+# columnas con nombre y se saltan los nombres que ya existen en la hoja)
+def nombres_columnas(encabezados):
+    nombres = [f"Unnamed: {i}" if e in (None, "") else e for i, e in enumerate(encabezados)]
+    sin_nombre = [i for i, e in enumerate(encabezados) if e in (None, "")]
+    con_nombre = [i for i in range(len(nombres)) if i not in sin_nombre]
+    cuentas = {}
+    for i in con_nombre + sin_nombre:
+        original = nombre = nombres[i]
+        cuenta = cuentas.get(nombre, 0)
+        while cuenta > 0:
+            cuentas[original] = cuenta + 1
+            nombre = f"{original}.{cuenta}"
+            if nombre in nombres:
+                cuenta += 1
+            else:
+                cuenta = cuentas.get(nombre, 0)
+        nombres[i] = nombre
+        cuentas[nombre] = cuenta + 1
+    return nombres
+
+# DataFrame posicional: la fila i es la fila i + 2 de la hoja (indexar_codigos
+# depende de eso), así que aquí no se descarta ninguna fila ni columna
+def hoja_a_dataframe(sheet):
+    filas = list(sheet.iter_rows(values_only=True))
+    if not filas:
+        return pd.DataFrame()
+    return pd.DataFrame(filas[1:], columns=nombres_columnas(filas[0]))
+
+# Lectura cacheada: solo se repite cuando cambia la fecha de modificación del archivo.
+# max_entries evita acumular una copia del inventario por cada guardado.
+@st.cache_data(max_entries=2)
+def cargar_inventario(path, mtime):
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        df = hoja_a_dataframe(wb.active)
+    finally:
+        wb.close()
+
+    # Igual que pd.read_excel para la tabla: se quitan las filas vacías del final
+    # (celdas con formato pero sin valor) y las columnas del final sin encabezado
+    # ni datos
+    con_datos = np.flatnonzero(df.notna().any(axis=1).to_numpy())
+    df = df.iloc[:con_datos[-1] + 1 if len(con_datos) else 0]
+    columnas = len(df.columns)
+    while columnas and str(df.columns[columnas - 1]).startswith("Unnamed: ") and df.iloc[:, columnas - 1].isna().all():
+        columnas -= 1
+    return df.iloc[:, :columnas]
+
+# Bytes del archivo para la descarga; solo se vuelve a leer del disco si cambió
+@st.cache_data(max_entries=2)
+def leer_archivo(path, mtime):
+    with open(path, "rb") as f:
+        return f.read()
+
+df = cargar_inventario(EXCEL_PATH, os.path.getmtime(EXCEL_PATH))
 
 codigo_columna = None
 for col in df.columns:
-    if "codigo" in col.lower():
+    if "codigo" in str(col).lower():
         codigo_columna = col
         break
 
@@ -47,78 +136,202 @@ if not codigo_columna:
     st.error("No existe una columna llamada 'codigo' en el archivo.")
     st.stop()
 
-codigo_a_fila = {str(row[codigo_columna]).strip(): idx + 2 for idx, row in df.iterrows()}
+# Índice código -> fila de la hoja
+def indexar_codigos(sheet, columna):
+    df = hoja_a_dataframe(sheet)
+    return dict(zip(df[columna].astype(str).str.strip(), range(2, len(df) + 2)))
 
+# Libro abierto y su índice, compartidos entre reruns y sesiones: evita volver a
+# cargar todo el XML en cada marca. Solo se recarga si el archivo cambió en disco.
+# Con el lock tomado no se llama a ninguna función cacheada de Streamlit (tienen
+# sus propios locks y podrían bloquearse mutuamente).
 @st.cache_resource
-def cargar_ocr():
-    return easyocr.Reader(['es', 'en'])
-
-reader = cargar_ocr()
-
-st.subheader("Escanea el código")
-img_file = st.camera_input("Toma una foto del código")
+def libro_abierto():
+    return {"lock": threading.Lock(), "wb": None, "indice": None, "mtime": None}
+
+# Marca el código (verde si existe, morado si es nuevo) y guarda el Excel.
+def actualizar_excel(codigo):
+    libro = libro_abierto()
+    with libro["lock"]:
+        mtime = os.path.getmtime(EXCEL_PATH)
+        if libro["mtime"] != mtime:
+            libro["wb"] = load_workbook(EXCEL_PATH)
+            libro["indice"] = indexar_codigos(libro["wb"].active, codigo_columna)
+            libro["mtime"] = mtime
+        wb = libro["wb"]
+        sheet = wb.active
+        codigo_a_fila = libro["indice"]
+        encontrado = codigo in codigo_a_fila
+
+        if encontrado:
+            celda = sheet[f"A{codigo_a_fila[codigo]}"]
+            # Si ya estaba marcado no hay nada que escribir: se evita reescribir
+            # todo el archivo y el backup
+            if celda.fill == COLOR_VERDE and celda.font.b:
+                return encontrado
+
+        # Si algo falla antes de guardar, el libro en memoria se descarta
+        libro["mtime"] = None
+        # Solo se cambian relleno y fuente: bordes, alineación y formato de la
+        # celda se conservan
+        if encontrado:
+            celda.fill = COLOR_VERDE
+        else:
+            nueva_fila = sheet.max_row + 1
+            celda = sheet[f"A{nueva_fila}"]
+            celda.value = codigo
+            celda.fill = COLOR_MORADO
+            codigo_a_fila[codigo] = nueva_fila
+        celda.font = Font(bold=True)
+
+        # Se guarda en un archivo nuevo y se reemplaza: el backup (enlace duro)
+        # conserva la versión anterior y un fallo no deja el Excel a medias
+        tmp = EXCEL_PATH + ".tmp"
+        wb.save(tmp)
+        os.replace(tmp, EXCEL_PATH)
+        libro["mtime"] = os.path.getmtime(EXCEL_PATH)
+
+        # Crear backup como máximo una vez por hora en cada sesión. Se hace con
+        # el lock tomado: dos sesiones no pueden pisarse el archivo temporal
+        if time.time() - st.session_state.get("ultimo_backup", 0) > INTERVALO_BACKUP:
+            crear_backup()
+            st.session_state["ultimo_backup"] = time.time()
+
+    registrar(codigo, "encontrado" if encontrado else "nuevo")
+    return encontrado
 
-codigo_detectado = None
+@st.cache_resource
+def cargar_ocr():
+    # Importación diferida: torch solo se carga cuando hace falta el OCR
+    import easyocr
 
-if img_file:
-    img = Image.open(img_file)
-    img_array = np.array(img)
+    # EasyOCR ya aplica por defecto (quantize=True) la cuantización dinámica
+    # INT8 del reconocedor cuando corre en CPU
+    return easyocr.Reader(['es', 'en'])
 
-    # Preprocesar imagen para mejor OCR
+FRASES_PROHIBIDAS = [
+    "sistemadeinformacionbibliografico",
+    "sistemadeinformacion",
+    "bibliografico",
+    "biblioteca",
+    "universidad",
+    "cooperativa",
+    "colombia"
+]
+
+# Patrones compilados una sola vez al importar
+PATRON_PROHIBIDAS = re.compile("|".join(map(re.escape, FRASES_PROHIBIDAS)))
+TABLA_LIMPIEZA = str.maketrans("", "", " -")
+
+# Lado máximo de la imagen que se pasa a ZBar/OCR; más resolución solo suma tiempo
+LADO_MAXIMO = 960
+
+# Preprocesar imagen para mejor lectura (ZBar y OCR se benefician del contraste).
+# CLAHE ecualiza por zonas, mejor que un contraste global con luz desigual.
+def preprocesar_imagen(img):
+    # La cámara entrega JPEG: con draft el decodificador produce directamente la
+    # imagen en gris y reducida, sin crear la versión RGB a tamaño completo
+    escala = LADO_MAXIMO / max(img.size)
+    img.draft('L', (int(img.width * escala), int(img.height * escala)))
     img_gray = img.convert('L')
-    img_enhanced = ImageEnhance.Contrast(img_gray).enhance(2.0)
-    img_array = np.array(img_enhanced)
-
-    textos = reader.readtext(img_array, detail=0)
-
-    frases_prohibidas = [
-        "sistemadeinformacionbibliografico",
-        "sistemadeinformacion",
-        "bibliografico",
-        "biblioteca",
-        "universidad",
-        "cooperativa",
-        "colombia"
-    ]
-
+    img_gray.thumbnail((LADO_MAXIMO, LADO_MAXIMO))
+    # Se crea en cada llamada: el objeto CLAHE no es seguro entre hilos
+    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+    return clahe.apply(np.asarray(img_gray))
+
+# Binarización con umbral por vecindario (imagen integral): rescata códigos de
+# barras fotografiados con luz desigual
+def binarizar(img_array):
+    return cv2.adaptiveThreshold(img_array, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 31, 10)
+
+# Decodifica códigos de barras con ZBar; es mucho más rápido que el OCR
+def leer_codigos_barras(img_array):
+    if decode is None:
+        return []
+    simbolos = decode(img_array, symbols=[ZBarSymbol.CODE128, ZBarSymbol.CODE39, ZBarSymbol.EAN13])
+    return [s.data.decode() for s in simbolos]
+
+def leer_texto(img_array):
+    return cargar_ocr().readtext(img_array, detail=0)
+
+def detectar_codigos(textos):
     posibles_codigos = []
 
     for t in textos:
-        t_limpio = t.lower().replace(" ", "").replace("-", "").strip()
+        t_limpio = t.lower().translate(TABLA_LIMPIEZA).strip()
 
-        if any(frase in t_limpio for frase in frases_prohibidas):
+        # Descarte rápido: la mayoría de los textos no empiezan por "b"
+        if not t_limpio.startswith("b") or len(t_limpio) < 7:
             continue
 
-        if re.fullmatch(r"b\d{6,8}", t_limpio):
-            posibles_codigos.append(t_limpio.upper())
+        if PATRON_PROHIBIDAS.search(t_limpio):
             continue
 
-        if t_limpio.startswith("b") and len(t_limpio) >= 7:
-            posibles_codigos.append(t_limpio.upper())
+        posibles_codigos.append(t_limpio.upper())
 
     if posibles_codigos:
-        codigo_detectado = max(posibles_codigos, key=len)
+        return max(posibles_codigos, key=len)
+    return None
+
+# Umbrales para descartar fotos antes del OCR, calibrados sobre la salida de
+# preprocesar_imagen (con CLAHE), no sobre el gris original: varianza del
+# laplaciano (enfoque) y rango entre el píxel más oscuro y el más claro
+# (fotos planas, todo negro o todo blanco). No se usa el brillo medio: una
+# etiqueta blanca de cerca con texto negro puede superar 245 y ser legible.
+UMBRAL_NITIDEZ = 50
+CONTRASTE_MINIMO = 40
+
+def imagen_nitida(img_array):
+    if np.ptp(img_array) < CONTRASTE_MINIMO:
+        return False
+    return cv2.Laplacian(img_array, cv2.CV_64F).var() >= UMBRAL_NITIDEZ
+
+# Resultado cacheado por hash de la foto: mientras la cámara devuelva la misma
+# imagen, los reruns no repiten ZBar ni OCR
+@st.cache_data(max_entries=8)
+def detectar_codigo_foto(digest, _img_bytes):
+    img_array = preprocesar_imagen(Image.open(io.BytesIO(_img_bytes)))
+    codigo = detectar_codigos(leer_codigos_barras(img_array))
+    # Segundo intento con ZBar sobre la imagen binarizada: cuesta milisegundos
+    # frente a los segundos del OCR
+    if not codigo and decode is not None:
+        codigo = detectar_codigos(leer_codigos_barras(binarizar(img_array)))
+    if codigo:
+        return codigo, True
+    # Una foto borrosa o casi negra/blanca no vale los segundos del OCR
+    if not imagen_nitida(img_array):
+        return None, False
+    # El OCR solo se carga y ejecuta si ZBar no encontró un código válido
+    return detectar_codigos(leer_texto(img_array)), True
+
+st.subheader("Escanea el código")
+if decode is None:
+    st.info("No se encontró la librería ZBar (libzbar0): los códigos se leerán solo con OCR, que es más lento.")
+img_file = st.camera_input("Toma una foto del código")
+
+codigo_detectado = None
+
+if img_file:
+    img_bytes = img_file.getvalue()
+    digest = hashlib.blake2b(img_bytes, digest_size=16).hexdigest()
+    codigo_detectado, foto_nitida = detectar_codigo_foto(digest, img_bytes)
+
+    if codigo_detectado:
         st.success(f"Código detectado: **{codigo_detectado}**")
 
-        if codigo_detectado in codigo_a_fila:
-            fila = codigo_a_fila[codigo_detectado]
-            celda = f"A{fila}"
-            sheet[celda].fill = COLOR_VERDE
-            sheet[celda].font = Font(bold=True)
+        # Cada foto se aplica al Excel una sola vez: los reruns que siguen mostrando
+        # la misma imagen no vuelven a guardar (ni pasan un código nuevo a verde)
+        if st.session_state.get("foto_aplicada") != digest:
+            st.session_state["foto_encontrada"] = actualizar_excel(codigo_detectado)
+            st.session_state["foto_aplicada"] = digest
+
+        if st.session_state["foto_encontrada"]:
             st.success(f"✔ Código {codigo_detectado} encontrado y marcado en verde.")
         else:
-            nueva_fila = sheet.max_row + 1
-            sheet[f"A{nueva_fila}"] = codigo_detectado
-            sheet[f"A{nueva_fila}"].fill = COLOR_MORADO
-            sheet[f"A{nueva_fila}"].font = Font(bold=True)
-            # Actualizar el mapeo para futuros escaneos
-            codigo_a_fila[codigo_detectado] = nueva_fila
             st.warning(f"➕ Código nuevo agregado: {codigo_detectado}")
 
-        wb.save(EXCEL_PATH)
-        # Crear backup
-        crear_backup()
-
+    elif not foto_nitida:
+        st.warning("La imagen está borrosa o mal iluminada. Toma otra foto.")
     else:
         st.warning("No se encontró un código válido en la imagen.")
         
@@ -133,30 +346,21 @@ if st.button("Procesar Código Manual"):
     if codigo_manual:
         codigo_manual = codigo_manual.strip().upper()
 
-        if codigo_manual in codigo_a_fila:
-            fila = codigo_a_fila[codigo_manual]
-            celda = f"A{fila}"
-            sheet[celda].fill = COLOR_VERDE
-            sheet[celda].font = Font(bold=True)
+        if actualizar_excel(codigo_manual):
             st.success(f"✔ Código {codigo_manual} encontrado y marcado en verde.")
-
         else:
-            nueva_fila = sheet.max_row + 1
-            sheet[f"A{nueva_fila}"] = codigo_manual
-            sheet[f"A{nueva_fila}"].fill = COLOR_MORADO
-            sheet[f"A{nueva_fila}"].font = Font(bold=True)
-            codigo_a_fila[codigo_manual] = nueva_fila
             st.warning(f"➕ Código nuevo agregado manualmente: {codigo_manual}")
 
-        wb.save(EXCEL_PATH)
-        crear_backup()
         st.session_state['codigo_manual'] = ''  # Resetear el input
         st.rerun()  # Forzar recarga para vaciar el campo inmediatamente
     else:
         st.warning("Por favor, ingresa un código antes de procesar.")
     
 st.subheader("Inventario actualizado")
-st.dataframe(pd.read_excel(EXCEL_PATH))
+st.dataframe(cargar_inventario(EXCEL_PATH, os.path.getmtime(EXCEL_PATH)))
 
-with open(EXCEL_PATH, "rb") as f:
-    st.download_button("Descargar inventario actualizado", f, file_name="inventario_actualizado.xlsx")
+st.download_button(
+    "Descargar inventario actualizado",
+    leer_archivo(EXCEL_PATH, os.path.getmtime(EXCEL_PATH)),
+    file_name="inventario_actualizado.xlsx"
+)